@@ -17,6 +17,8 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import collections
+import concurrent.futures
+import functools
 import re
 import sys
 import subprocess
@@ -25,9 +27,21 @@ import dateutil.parser
 import os
 import json
 import io
+import itertools
+import bisect
+import struct
+import wave
 from xml.etree import ElementTree
 
 class Video:
+    __slots__ = ('raw_video',
+                 'start_time',
+                 'end_time',
+                 'sounds',
+                 'script',
+                 'filter',
+                 'use_gpx')
+
     def __init__(self, raw_video, start_time, end_time):
         self.raw_video = raw_video
         self.start_time = start_time
@@ -47,24 +61,59 @@ class Video:
         return self.end_time_or_length() - self.start_time
 
 class RawVideo:
+    __slots__ = ('filename',
+                 'is_image',
+                 'is_proc',
+                 'probe',
+                 '_width',
+                 '_height',
+                 '_length')
+
     def __init__(self, filename, length=None):
         self.filename = filename
-        self.is_image = re.search(r'\.(?:jpe?g|png)$', filename) is not None
+        self.is_image = filename.endswith(IMAGE_EXTENSIONS)
         self.is_proc = filename.startswith("|")
 
-        self.width = None
-        self.height = None
+        self._width = None
+        self._height = None
 
         if self.is_proc or self.is_image:
-            self.length = self
+            self.probe = None
+            self._length = self
         else:
-            self.video_info = get_video_info(filename)
-            self.length = float(self.video_info['format']['duration'])
-            for stream in self.video_info['streams']:
-                if 'width' in stream:
-                    self.width = int(stream['width'])
-                    self.height = int(stream['height'])
-                    break
+            # Start ffprobe in the background and only wait for the
+            # result when it is first needed so that all of the videos
+            # can be probed at the same time
+            self.probe = probe_executor.submit(get_video_info, filename)
+
+    def wait_for_probe(self):
+        if self.probe is None:
+            return
+
+        video_info = self.probe.result()
+        self.probe = None
+
+        self._length = float(video_info['format']['duration'])
+        for stream in video_info['streams']:
+            if 'width' in stream:
+                self._width = int(stream['width'])
+                self._height = int(stream['height'])
+                break
+
+    @property
+    def length(self):
+        self.wait_for_probe()
+        return self._length
+
+    @property
+    def width(self):
+        self.wait_for_probe()
+        return self._width
+
+    @property
+    def height(self):
+        self.wait_for_probe()
+        return self._height
 
 class Script:
     def __init__(self):
@@ -87,12 +136,14 @@ class Script:
         self.distance_offset = None
         self.dial = False
         self.text_color = None
+        self.has_sound = False
 
 Svg = collections.namedtuple('Svg', ['video',
                                      'filename',
                                      'start_time',
                                      'length'])
-Sound = collections.namedtuple('Sound', ['start_time', 'filename', 'length'])
+# The length of a sound is available with get_sound_length
+Sound = collections.namedtuple('Sound', ['start_time', 'filename'])
 SpeedOverride = collections.namedtuple('SpeedOverride',
                                        ['raw_video',
                                         'start_time',
@@ -100,103 +151,186 @@ SpeedOverride = collections.namedtuple('SpeedOverride',
                                         'speed'])
 # Length is the time in seconds of the source video, ie, not accelerated
 VideoSpeed = collections.namedtuple('VideoSpeed', ['length', 'speed'])
-# Filename can be None if silence should be played
-SoundClip = collections.namedtuple('SoundClip', ['filename', 'length'])
+# start_time is the time in the output video where the sound starts
+SoundClip = collections.namedtuple('SoundClip', ['start_time', 'filename'])
 ScoreDiff = collections.namedtuple('ScoreDiff', ['video', 'time', 'diff'])
 
-TIME_RE = re.compile(r'(?:([0-9]+):)?([0-9]+)(\.[0-9]+)?')
-GOPRO_FILENAME_RE = re.compile(r'(?P<camera_type>G[HX])'
+# Regex source for a time in the form [[HH:]MM:]SS[.fff]. This is only
+# used to build the bigger line regexes so it has no capturing groups
+# of its own.
+TIME_PATTERN = r'(?:[0-9]+:){0,2}[0-9]+(?:\.[0-9]+)?'
+GOPRO_FILENAME_RE = re.compile(r'\A(?P<camera_type>G[HX])'
                                r'(?P<chapter>[0-9]{2})'
                                r'(?P<file_number>[0-9]{4})\.mp4\Z',
-                               flags=re.I)
+                               flags=re.I | re.ASCII)
+
+# The name of each kind of line in the script along with a regex to
+# recognise it. These are combined into a single regex and the name of
+# the outer group that matched tells which kind of line it is. They
+# are tried in order so anything that isn’t recognised ends up as a
+# video.
+LINE_PATTERNS = [
+    ('flootay_file', r'flootay_file\s+(?P<flootay_filename>.*?)\s*$'),
+    ('output_size',
+     r'output_size\s+(?P<output_width>[0-9]+)x(?P<output_height>[0-9]+)$'),
+    ('filter', r'filter\s+(?P<filter_string>.*)'),
+    ('sound_args', r'sound_args\s+(?P<sound_args_string>.*)'),
+    ('slow',
+     r'slow(?:\s+(?P<slow_start_time>' + TIME_PATTERN + r')'
+     r'(?:\s+(?P<slow_end_time>' + TIME_PATTERN + r'))?)?$'),
+    ('speed',
+     r'(?P<speed_factor>[0-9]+(?:\.[0-9]+)?)x'
+     r'(?:\s+(?P<speed_start_time>' + TIME_PATTERN + r')'
+     r'(?:\s+(?P<speed_end_time>' + TIME_PATTERN + r'))?)?$'),
+    ('default_speed',
+     r'default_speed\s+(?P<default_speed_factor>[0-9]+(?:\.[0-9]+)?)x?$'),
+    ('distance_offset',
+     r'distance_offset\s+(?P<distance_offset_value>-?[0-9]+(?:\.[0-9]+)?)$'),
+    ('text_color', r'text_color\s+(?P<text_color_value>.*)'),
+    ('gpx_offset',
+     r'gpx_offset\s+(?P<gpx_video_filename>\S+)\s+'
+     r'(?P<gpx_video_time>' + TIME_PATTERN + r')\s+'
+     r'(?P<gpx_utc_time>\S+)'
+     r'(?:\s+(?P<gpx_filename>\S.*))?$'),
+    ('svg',
+     r'(?P<svg_start_time>' + TIME_PATTERN + r')\s+'
+     r'(?P<svg_length>' + TIME_PATTERN + r')\s+'
+     r'(?P<svg_filename>.*\.svg)\s*$'),
+    ('score',
+     r'(?P<score_time>' + TIME_PATTERN + r')\s+'
+     r'(?P<score_diff>[+-][0-9]+)\s*$'),
+    ('sound',
+     r'(?P<sound_time>' + TIME_PATTERN + r')\s+'
+     r'(?P<sound_filename>.*)'),
+    ('video',
+     r'(?P<video_filename>.*?)'
+     r'(?:\s+(?P<video_start_time>' + TIME_PATTERN + r')'
+     r'(?:\s+(?P<video_end_time>' + TIME_PATTERN + r'))?)?$'),
+]
+LINE_RE = re.compile("|".join("(?P<{}>{})".format(kind, pattern)
+                              for kind, pattern in LINE_PATTERNS))
+
+# Kinds of line that modify the most recently added video
+VIDEO_LINE_KINDS = frozenset(['filter', 'slow', 'speed',
+                              'svg', 'score', 'sound'])
+
+SCRIPT_TIME_RE = re.compile(r'\bkey_frame\s+(?P<time>' +
+                            TIME_PATTERN +
+                            r')')
+FLOOTAY_FILTER_RE = re.compile(r'^\s*...\s+flootay\s+', flags=re.MULTILINE)
+GPX_ROOT_TAG_RE = re.compile(r'({http://www\.topografix\.com/GPX/1/[01]})'
+                             r'gpx\Z')
+
+# Directory containing speedy.py, used to find the other tools and
+# data files
+SCRIPT_DIR = os.path.dirname(sys.argv[0])
 
 FPS = 30
 
 OVERLAY_FILTER = "overlay=eof_action=pass"
 
+# Files with these extensions are treated as still images instead of
+# videos. The check is case-sensitive.
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+# Running ffprobe is mostly spent waiting for the subprocess so the
+# probes are run from a pool of threads
+probe_executor = concurrent.futures.ThreadPoolExecutor()
+
+# Probe results are saved in this file in the current directory so
+# that running the script again doesn’t have to probe the media files
+# that haven’t changed
+PROBE_CACHE_FILENAME = ".speedy-probe-cache.json"
+# This must be increased whenever the format of the cache or the result
+# of any of the probe functions changes so that old entries are thrown
+# away
+PROBE_CACHE_VERSION = 3
+
+# Lines in the script that just consist of a single keyword and the
+# attribute of the script that they set to True
+FLAG_KEYWORDS = {
+    "elevation": "show_elevation",
+    "distance": "show_distance",
+    "map": "show_map",
+    "time": "show_time",
+    "dial": "dial",
+    "twitter": "twitter",
+    "silent": "silent",
+}
+
 class ParseError(Exception):
     pass
 
+# Scripts tend to reuse the same few times in lots of places, such as
+# in the key frames of the embedded scripts, so the result is memoised
+@functools.lru_cache(maxsize=4096)
 def decode_time(time_str):
-    md = TIME_RE.match(time_str)
-    seconds = int(md.group(2))
+    # time_str has already been matched against TIME_PATTERN so it
+    # can be split directly without going through the regex engine
+    # again
+    minutes, _, seconds = time_str.rpartition(':')
 
-    if md.group(1):
-        seconds += int(md.group(1)) * 60
+    if '.' in seconds:
+        seconds = float(seconds)
+    else:
+        seconds = int(seconds)
 
-    if md.group(3):
-        seconds += float("0" + md.group(3))
+    if minutes:
+        hours, _, minutes = minutes.rpartition(':')
+        seconds += int(minutes) * 60
+
+        if hours:
+            seconds += int(hours) * 3600
 
     return seconds
 
-def parse_script(infile):
-    sound_re = re.compile(r'(?P<time>' +
-                          TIME_RE.pattern +
-                          r')' +
-                          r'\s+(?P<filename>.*)')
-    video_re = re.compile(r'(?P<filename>.*?)' +
-                          r'(?:\s+(?P<start_time>' +
-                          TIME_RE.pattern +
-                          r')(?:\s+(?P<end_time>' +
-                          TIME_RE.pattern +
-                          r'))?)?$')
-    score_re = re.compile(r'(?P<time>' +
-                          TIME_RE.pattern +
-                          r')\s+(?P<diff>[+-][0-9]+)\s*$')
-    svg_re = re.compile(r'(?P<start_time>' +
-                        TIME_RE.pattern +
-                        r')\s+(?P<length>' +
-                        TIME_RE.pattern +
-                        r')\s+(?P<filename>.*\.svg)\s*$')
-    gpx_offset_re = re.compile(r'gpx_offset\s+(?P<filename>\S+)\s+'
-                               r'(?P<video_time>'
-                               + TIME_RE.pattern +
-                               r')\s+(?P<utc_time>\S+)'
-                               r'(?:\s+(?P<gpx_filename>\S.*))?$')
-    slow_re = re.compile(r'slow(?:\s+(?P<start_time>' +
-                         TIME_RE.pattern +
-                         r')(?:\s+(?P<end_time>' +
-                         TIME_RE.pattern +
-                         r'))?)?$')
-    speed_re = re.compile(r'(?P<speed>[0-9]+(?:\.[0-9]+)?)x(?:\s+'
-                          r'(?P<start_time>' +
-                          TIME_RE.pattern +
-                          r')(?:\s+(?P<end_time>' +
-                          TIME_RE.pattern +
-                          r'))?)?$')
-    sound_args_re = re.compile(r'sound_args\s+(?P<args>.*)')
-    filter_re = re.compile(r'filter\s+(?P<filter>.*)')
-    output_size_re = re.compile(r'output_size\s+([0-9]+)x([0-9]+)$')
-    default_speed_re = re.compile(r'default_speed\s+'
-                                  r'(?P<speed>[0-9]+(?:\.[0-9]+)?)x?$')
-    flootay_file_re = re.compile(r'flootay_file\s+(?P<filename>.*?)\s*$')
-    distance_offset_re = re.compile(r'distance_offset\s+'
-                                    r'(?P<offset>-?[0-9]+(?:\.[0-9]+)?)$')
-    text_color_re = re.compile(r'text_color\s+(?P<color>.*)')
+# Cache of the set of filenames in each directory that has been
+# looked at so that checking for a file next to each video only needs
+# to read each directory once instead of doing a stat for every file
+directory_listings = {}
+
+def file_exists_cached(filename):
+    dirname, basename = os.path.split(filename)
+
+    try:
+        listing = directory_listings[dirname]
+    except KeyError:
+        try:
+            listing = frozenset(os.listdir(dirname or "."))
+        except OSError:
+            listing = frozenset()
+        directory_listings[dirname] = listing
+
+    return basename in listing
 
+def get_gpx_start_time(gpx_filename):
+    tree = ElementTree.parse(gpx_filename)
+
+    md = GPX_ROOT_TAG_RE.match(tree.getroot().tag)
+
+    if md == None:
+        raise ParseError(("{} does not appear to be "
+                          "a GPX file").format(gpx_filename))
+
+    xpath = "./{}trk/{}trkseg/{}trkpt/{}time".replace("{}", md.group(1))
+    first_time = tree.getroot().find(xpath)
+    return dateutil.parser.parse(first_time.text).timestamp()
+
+def parse_script(infile):
     raw_videos = {}
     script = Script()
-
-    in_script = False
+    # The most recently added video that the following lines apply to
+    current_video = None
 
     def maybe_add_gpx_offset(filename):
         gpx_filename = os.path.splitext(filename)[0] + ".gpx"
 
-        if not os.path.exists(gpx_filename):
+        if not file_exists_cached(gpx_filename):
             return
 
-        tree = ElementTree.parse(gpx_filename)
-
-        md = re.match(r'({http://www\.topografix\.com/GPX/1/[01]})gpx\Z',
-                      tree.getroot().tag)
-
-        if md == None:
-            raise ParseError(("{} does not appear to be "
-                              "a GPX file").format(gpx_filename))
-
-        xpath = "./{}trk/{}trkseg/{}trkpt/{}time".replace("{}", md.group(1))
-        first_time = tree.getroot().find(xpath)
-        timestamp = dateutil.parser.parse(first_time.text).timestamp()
+        # GPX files can be large so the start time is kept in the probe
+        # cache instead of parsing the whole file every time
+        timestamp = cached_probe("gpx", get_gpx_start_time, gpx_filename)
         script.gpx_offsets[os.path.basename(filename)] = (timestamp,
                                                           gpx_filename)
 
@@ -211,211 +345,206 @@ def parse_script(infile):
 
             return raw_video
 
-    def add_speed_override_from_md(speed, md):
-        if md.group('start_time') is None:
-            start_time = script.videos[-1].start_time
+    def add_speed_override(speed, start_time, end_time):
+        if start_time is None:
+            start_time = current_video.start_time
         else:
-            start_time = decode_time(md.group('start_time'))
+            start_time = decode_time(start_time)
 
-        if md.group('end_time') is None:
-            end_time = script.videos[-1].end_time_or_length()
+        if end_time is None:
+            end_time = current_video.end_time_or_length()
         else:
-            end_time = decode_time(md.group('end_time'))
+            end_time = decode_time(end_time)
 
-        script.speed_overrides.append(SpeedOverride(script.videos[-1].raw_video,
+        script.speed_overrides.append(SpeedOverride(current_video.raw_video,
                                                     start_time,
                                                     end_time - start_time,
                                                     speed))
     
-    for line_num, line in enumerate(infile):
-        line = line.strip()
-
-        if in_script:
-            if line == "}}":
-                in_script = False
-            elif len(script.videos) == 0:
-                script.extra_script.append(line)
-            else:
-                script.videos[-1].script.append(line)
-            continue
+    def add_flootay_file(md):
+        with open(md.group('flootay_filename'), "rt", encoding="utf-8") as f:
+            contents = f.read()
+        if current_video is None:
+            script.extra_script.append(contents)
+        else:
+            current_video.script.append(contents)
 
-        if line == "{{":
-            in_script = True
-            continue
+    def set_output_size(md):
+        script.width = int(md.group('output_width'))
+        script.height = int(md.group('output_height'))
 
-        if len(line) <= 0 or line[0] == '#':
-            continue
+    def add_filter(md):
+        current_video.filter.append(md.group('filter_string'))
 
-        if line == "logo":
-            video_filename = ("|" +
-                              os.path.join(os.path.dirname(sys.argv[0]),
-                                           "build",
-                                           "generate-logo"))
-            raw_video = get_raw_video(video_filename, 3)
-            video = Video(raw_video, 0, 3)
-            script.videos.append(video)
-            sound_filename = os.path.join(os.path.dirname(sys.argv[0]),
-                                          "logo-sound.flac")
-            video.sounds.append(Sound(0,
-                                      sound_filename,
-                                      get_sound_length(sound_filename)))
-            script.speed_overrides.append(SpeedOverride(raw_video,
-                                                        0, # start_time
-                                                        3, # end_time
-                                                        1.0))
-            continue
+    def add_sound_args(md):
+        script.sound_args.extend(shlex.split(md.group('sound_args_string')))
 
-        if line == "elevation":
-            script.show_elevation = True
-            continue
+    def add_slow(md):
+        add_speed_override(1.0,
+                           md.group('slow_start_time'),
+                           md.group('slow_end_time'))
 
-        if line == "distance":
-            script.show_distance = True
-            continue
+    def set_default_speed(md):
+        script.default_speed = 1.0 / float(md.group('default_speed_factor'))
 
-        if line == "map":
-            script.show_map = True
-            continue
+    def set_distance_offset(md):
+        script.distance_offset = float(md.group('distance_offset_value'))
 
-        if line == "time":
-            script.show_time = True
-            continue
+    def set_text_color(md):
+        script.text_color = md.group('text_color_value')
 
-        if line == "dial":
-            script.dial = True
-            continue
+    def add_gpx_offset(md):
+        timestamp = dateutil.parser.parse(md.group('gpx_utc_time'))
+        offset = (timestamp.timestamp() -
+                  decode_time(md.group('gpx_video_time')))
+        gpx_filename = md.group('gpx_filename') or "speed.gpx"
+        script.gpx_offsets[md.group('gpx_video_filename')] = (offset,
+                                                              gpx_filename)
 
-        if line == "twitter":
-            script.twitter = True
-            continue
+    def add_speed(md):
+        add_speed_override(1.0 / float(md.group('speed_factor')),
+                           md.group('speed_start_time'),
+                           md.group('speed_end_time'))
 
-        if line == "silent":
-            script.silent = True
-            continue
+    def add_svg(md):
+        script.svgs.append(Svg(current_video,
+                               md.group('svg_filename'),
+                               decode_time(md.group('svg_start_time')),
+                               decode_time(md.group('svg_length'))))
 
-        if line == "no_gpx":
-            script.videos[-1].use_gpx = False
-            continue
+    def add_score(md):
+        script.scores.append(ScoreDiff(current_video,
+                                       decode_time(md.group('score_time')),
+                                       int(md.group('score_diff'))))
 
-        md = flootay_file_re.match(line)
-        if md:
-            with open(md.group('filename'), "rt", encoding="utf-8") as f:
-                contents = f.read()
-            if len(script.videos) == 0:
-                script.extra_script.append(contents)
-            else:
-                script.videos[-1].script.append(contents)
-            continue
+    def add_sound(md):
+        start_time = decode_time(md.group('sound_time'))
+        filename = md.group('sound_filename')
+        start_sound_probe(filename)
 
-        md = output_size_re.match(line)
-        if md:
-            script.width = int(md.group(1))
-            script.height = int(md.group(2))
-            continue
+        sound = Sound(start_time, filename)
+        current_video.sounds.append(sound)
 
-        md = filter_re.match(line)
-        if md:
-            script.videos[-1].filter.append(md.group('filter'))
-            continue
+    def add_video(md):
+        nonlocal current_video
 
-        md = sound_args_re.match(line)
-        if md:
-            script.sound_args.extend(shlex.split(md.group('args')))
-            continue
+        filename = md.group('video_filename')
 
-        md = slow_re.match(line)
-        if md:
-            add_speed_override_from_md(1.0, md)
-            continue
+        start_time = md.group('video_start_time')
+        if start_time:
+            start_time = decode_time(start_time)
+        else:
+            start_time = 0
 
-        md = speed_re.match(line)
-        if md:
-            add_speed_override_from_md(1.0 / float(md.group('speed')), md)
-            continue
+        end_time = md.group('video_end_time')
+        if end_time:
+            end_time = decode_time(end_time)
+            potential_raw_length = end_time - start_time
+        else:
+            potential_raw_length = None
 
-        md = default_speed_re.match(line)
-        if md:
-            script.default_speed = 1.0 / float(md.group('speed'))
-            continue
+        raw_video = get_raw_video(filename, potential_raw_length)
 
-        md = distance_offset_re.match(line)
-        if md:
-            script.distance_offset = float(md.group('offset'))
-            continue
+        current_video = Video(raw_video, start_time, end_time)
+        script.videos.append(current_video)
+
+    def add_logo():
+        nonlocal current_video
+
+        video_filename = ("|" +
+                          os.path.join(SCRIPT_DIR,
+                                       "build",
+                                       "generate-logo"))
+        raw_video = get_raw_video(video_filename, 3)
+        current_video = Video(raw_video, 0, 3)
+        script.videos.append(current_video)
+        sound_filename = os.path.join(SCRIPT_DIR,
+                                      "logo-sound.flac")
+        start_sound_probe(sound_filename)
+        current_video.sounds.append(Sound(0, sound_filename))
+        script.speed_overrides.append(SpeedOverride(raw_video,
+                                                    0, # start_time
+                                                    3, # end_time
+                                                    1.0))
+
+    def disable_gpx():
+        current_video.use_gpx = False
+
+    # Lines that consist of just a single keyword are looked up
+    # directly without trying the regex
+    keyword_handlers = {
+        "logo": add_logo,
+        "no_gpx": disable_gpx,
+    }
+
+    for keyword, attr in FLAG_KEYWORDS.items():
+        keyword_handlers[keyword] = functools.partial(setattr,
+                                                      script,
+                                                      attr,
+                                                      True)
+
+    # Function to call for each kind of line matched by LINE_RE
+    line_handlers = {
+        'flootay_file': add_flootay_file,
+        'output_size': set_output_size,
+        'filter': add_filter,
+        'sound_args': add_sound_args,
+        'slow': add_slow,
+        'speed': add_speed,
+        'default_speed': set_default_speed,
+        'distance_offset': set_distance_offset,
+        'text_color': set_text_color,
+        'gpx_offset': add_gpx_offset,
+        'svg': add_svg,
+        'score': add_score,
+        'sound': add_sound,
+        'video': add_video,
+    }
+
+    lines = [line.strip() for line in infile.readlines()]
+
+    next_line = 0
+
+    while next_line < len(lines):
+        line_num = next_line
+        line = lines[line_num]
+        next_line += 1
 
-        md = text_color_re.match(line)
-        if md:
-            script.text_color = md.group('color')
-            continue
+        if line == "{{":
+            # Embedded flootay scripts can be very long so the end of
+            # the block is found in one go instead of looking at each
+            # line in the loop
+            try:
+                end = lines.index("}}", next_line)
+            except ValueError:
+                end = len(lines)
+
+            if current_video is None:
+                script.extra_script.extend(lines[next_line:end])
+            else:
+                current_video.script.extend(lines[next_line:end])
 
-        md = gpx_offset_re.match(line)
-        if md:
-            timestamp = dateutil.parser.parse(md.group('utc_time'))
-            offset = (timestamp.timestamp() -
-                      decode_time(md.group('video_time')))
-            gpx_filename = md.group('gpx_filename') or "speed.gpx"
-            script.gpx_offsets[md.group('filename')] = (offset, gpx_filename)
+            next_line = end + 1
             continue
 
-        md = svg_re.match(line)
-        if md:
-            if len(script.videos) <= 0:
-                raise ParseError(("line {}: svg specified "
-                                  "with no video").format(line_num + 1))
-
-            script.svgs.append(Svg(script.videos[-1],
-                                   md.group('filename'),
-                                   decode_time(md.group('start_time')),
-                                   decode_time(md.group('length'))))
-
-            continue
- 
-        md = score_re.match(line)
-        if md:
-            if len(script.videos) <= 0:
-                raise ParseError(("line {}: score specified "
-                                  "with no video").format(line_num + 1))
-
-            script.scores.append(ScoreDiff(script.videos[-1],
-                                           decode_time(md.group('time')),
-                                           int(md.group('diff'))))
+        if not line or line.startswith('#'):
             continue
 
-        md = sound_re.match(line)
-        if md:
-            if len(script.videos) <= 0:
-                raise ParseError(("line {}: sound specified "
-                                  "with no video").format(line_num + 1))
-
-            start_time = decode_time(md.group('time'))
-            filename = md.group('filename')
-            length = get_sound_length(filename)
-
-            sound = Sound(start_time, filename, length)
-            script.videos[-1].sounds.append(sound)
-
+        handler = keyword_handlers.get(line)
+        if handler is not None:
+            handler()
             continue
 
-        md = video_re.match(line)
+        md = LINE_RE.match(line)
+        kind = md.lastgroup
 
-        filename = md.group('filename')
-
-        start_time = md.group('start_time')
-        if start_time:
-            start_time = decode_time(start_time)
-        else:
-            start_time = 0
-
-        end_time = md.group('end_time')
-        if end_time:
-            end_time = decode_time(end_time)
-            potential_raw_length = end_time - start_time
-        else:
-            potential_raw_length = None
+        if kind in VIDEO_LINE_KINDS and current_video is None:
+            raise ParseError(("line {}: {} specified "
+                              "with no video").format(line_num + 1, kind))
 
-        raw_video = get_raw_video(filename, potential_raw_length)
+        line_handlers[kind](md)
 
-        script.videos.append(Video(raw_video, start_time, end_time))
+    script.has_sound = script_has_sound(script)
 
     return script
 
@@ -429,22 +558,244 @@ def script_has_sound(script):
 
     return False
 
-def is_normal_speed(video_speeds):
-    return len(video_speeds) == 1 and video_speeds[0].speed == 1
-
-def get_sound_mode(script, video_speeds):
+def get_sound_mode(script, time_map):
     if script.silent:
         return "silence"
 
-    if script_has_sound(script):
+    if script.has_sound:
         return "generate"
 
-    if is_normal_speed(video_speeds):
+    if time_map.is_normal_speed():
         return "original"
 
     return "silence"
 
+MP4_EXTENSIONS = ('.mp4', '.m4v', '.mov')
+
+def iterate_mp4_boxes(data, start, end):
+    pos = start
+
+    while pos + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', data, pos)
+        header_size = 8
+
+        if size == 1:
+            size, = struct.unpack_from('>Q', data, pos + 8)
+            header_size = 16
+        elif size == 0:
+            size = end - pos
+
+        if size < header_size or pos + size > end:
+            return
+
+        yield box_type, pos + header_size, pos + size
+
+        pos += size
+
+def read_mp4_moov(f):
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            return None
+
+        size, box_type = struct.unpack('>I4s', header)
+
+        if size == 1:
+            header = f.read(8)
+            if len(header) < 8:
+                return None
+            size, = struct.unpack('>Q', header)
+            size -= 16
+        elif size == 0:
+            if box_type == b'moov':
+                return f.read()
+            return None
+        else:
+            size -= 8
+
+        if size < 0:
+            return None
+
+        if box_type == b'moov':
+            data = f.read(size)
+            if len(data) < size:
+                return None
+            return data
+
+        f.seek(size, os.SEEK_CUR)
+
+def find_mp4_box(data, start, end, path):
+    # Returns the (start, end) of the contents of the first box found
+    # by following the list of box types in path, or None
+    for box_type in path:
+        for sub_type, sub_start, sub_end in iterate_mp4_boxes(data,
+                                                              start,
+                                                              end):
+            if sub_type == box_type:
+                start, end = sub_start, sub_end
+                break
+        else:
+            return None
+
+    return start, end
+
+class Mp4ProbeError(Exception):
+    pass
+
+def get_mp4_track_size(moov, start, end):
+    # Returns the frame size of a video track or None if the track
+    # isn’t a video. If the size of a video track can’t be trusted then
+    # Mp4ProbeError is raised so that the whole file is left to ffprobe
+    # instead of using the size from a later track.
+    hdlr = find_mp4_box(moov, start, end, [b'mdia', b'hdlr'])
+
+    if hdlr is None or moov[hdlr[0] + 8:hdlr[0] + 12] != b'vide':
+        return None
+
+    tkhd = find_mp4_box(moov, start, end, [b'tkhd'])
+    stsd = find_mp4_box(moov, start, end,
+                        [b'mdia', b'minf', b'stbl', b'stsd'])
+
+    if tkhd is None or stsd is None or stsd[0] + 8 + 8 + 28 > stsd[1]:
+        raise Mp4ProbeError()
+
+    # The width and height are the last two fields of the tkhd box and
+    # are 16.16 fixed-point
+    width, height = struct.unpack_from('>II', moov, tkhd[1] - 8)
+    track_size = (width >> 16, height >> 16)
+
+    # The tkhd size is the presentation size, which includes the pixel
+    # aspect ratio and rotation, but ffprobe reports the coded size
+    # from the sample description. The width and height of the first
+    # visual sample entry come after the stsd header (8 bytes), the
+    # entry header (8 bytes) and 24 bytes of other fields.
+    coded_size = struct.unpack_from('>HH', moov, stsd[0] + 8 + 8 + 24)
+
+    # If the two differ then the video is anamorphic or rotated, so
+    # leave it to ffprobe to work out what it reports
+    if coded_size != track_size:
+        raise Mp4ProbeError()
+
+    return coded_size
+
+def get_mp4_video_info(filename):
+    # Reads the duration and frame size directly from the moov box of
+    # an MP4 or QuickTime file to avoid having to start ffprobe. The
+    # result has the same layout as the JSON from ffprobe. If anything
+    # unexpected is found then None is returned so that the caller can
+    # fall back to ffprobe.
+    try:
+        with open(filename, "rb") as f:
+            moov = read_mp4_moov(f)
+
+        if moov is None:
+            return None
+
+        duration = None
+        size = None
+
+        for box_type, start, end in iterate_mp4_boxes(moov, 0, len(moov)):
+            if box_type == b'mvhd':
+                if moov[start] == 1:
+                    timescale, length = struct.unpack_from('>IQ',
+                                                           moov,
+                                                           start + 20)
+                    unknown_length = 0xffffffffffffffff
+                else:
+                    timescale, length = struct.unpack_from('>II',
+                                                           moov,
+                                                           start + 12)
+                    unknown_length = 0xffffffff
+                # A length of zero or all ones means that it isn’t
+                # known, so ffprobe has to work it out
+                if timescale > 0 and 0 < length < unknown_length:
+                    duration = length / timescale
+            elif box_type == b'mvex':
+                # Fragmented files keep the samples in moof boxes after
+                # the moov so the mvhd duration doesn’t cover them
+                return None
+            elif box_type == b'trak' and size is None:
+                size = get_mp4_track_size(moov, start, end)
+    except (OSError, struct.error, Mp4ProbeError):
+        return None
+
+    if duration is None or size is None:
+        return None
+
+    # ffprobe reports the duration rounded to microseconds
+    return {
+        'format': {'duration': "{:.6f}".format(duration)},
+        'streams': [{'width': size[0], 'height': size[1]}],
+    }
+
+def load_probe_cache():
+    try:
+        with open(PROBE_CACHE_FILENAME, "rt", encoding="utf-8") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    if (not isinstance(cache, dict) or
+        cache.get('version') != PROBE_CACHE_VERSION or
+        not isinstance(cache.get('entries'), dict)):
+        return {}
+
+    return cache['entries']
+
+probe_cache = load_probe_cache()
+probe_cache_changed = False
+
+def save_probe_cache():
+    if not probe_cache_changed:
+        return
+
+    # Make sure none of the probes are still adding to the cache
+    probe_executor.shutdown()
+
+    tmp_filename = PROBE_CACHE_FILENAME + ".tmp"
+
+    try:
+        with open(tmp_filename, "wt", encoding="utf-8") as f:
+            json.dump({'version': PROBE_CACHE_VERSION,
+                       'entries': probe_cache},
+                      f)
+        os.replace(tmp_filename, PROBE_CACHE_FILENAME)
+    except OSError as e:
+        print("warning: couldn’t save probe cache: {}".format(e),
+              file=sys.stderr)
+
+def cached_probe(kind, func, filename):
+    # Returns func(filename), reusing the result from a previous run if
+    # the file still has the same modification time and size
+    global probe_cache_changed
+
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return func(filename)
+
+    key = "{}:{}".format(kind, filename)
+    stamp = [st.st_mtime_ns, st.st_size]
+    entry = probe_cache.get(key)
+
+    if isinstance(entry, dict) and entry.get('stamp') == stamp:
+        return entry['value']
+
+    value = func(filename)
+    probe_cache[key] = {'stamp': stamp, 'value': value}
+    probe_cache_changed = True
+
+    return value
+
 def get_video_info(filename):
+    return cached_probe("video", probe_video_info, filename)
+
+def probe_video_info(filename):
+    if filename.lower().endswith(MP4_EXTENSIONS):
+        info = get_mp4_video_info(filename)
+        if info is not None:
+            return info
+
     with subprocess.Popen(["ffprobe",
                            "-i", filename,
                            "-show_entries", "format=duration:stream",
@@ -455,7 +806,58 @@ def get_video_info(filename):
 
     return info
 
-def get_sound_length(filename):
+def get_wav_length(filename):
+    # Returns the length of a WAV file from its header or None if the
+    # wave module can’t read it
+    try:
+        with wave.open(filename, "rb") as w:
+            length = w.getnframes() / w.getframerate()
+    except (OSError, EOFError, wave.Error, ZeroDivisionError):
+        return None
+
+    # Round the same way as the output from ffprobe
+    return float("{:.6f}".format(length))
+
+def get_flac_length(filename):
+    # Returns the length of a FLAC file from the STREAMINFO block or
+    # None if it can’t be found
+    try:
+        with open(filename, "rb") as f:
+            header = f.read(4 + 4 + 34)
+    except OSError:
+        return None
+
+    # The STREAMINFO block is required to be the first metadata block
+    if (len(header) < 4 + 4 + 34 or
+        header[0:4] != b"fLaC" or
+        header[4] & 0x7f != 0):
+        return None
+
+    # Sample rate (20 bits), channels (3), bits per sample (5) and the
+    # total number of samples (36)
+    bits = int.from_bytes(header[18:26], "big")
+    sample_rate = bits >> 44
+    n_samples = bits & ((1 << 36) - 1)
+
+    # A sample count of zero means that it isn’t known
+    if sample_rate == 0 or n_samples == 0:
+        return None
+
+    # Round the same way as the output from ffprobe
+    return float("{:.6f}".format(n_samples / sample_rate))
+
+SOUND_LENGTH_FUNCS = {
+    ".wav": get_wav_length,
+    ".flac": get_flac_length,
+}
+
+def probe_sound_length(filename):
+    length_func = SOUND_LENGTH_FUNCS.get(os.path.splitext(filename)[1].lower())
+    if length_func is not None:
+        length = length_func(filename)
+        if length is not None:
+            return length
+
     s = subprocess.check_output(["ffprobe",
                                  "-i", filename,
                                  "-show_entries", "format=duration",
@@ -463,110 +865,147 @@ def get_sound_length(filename):
                                  "-of", "csv=p=0"])
     return float(s)
 
-def get_videos_length(videos):
-    total_length = 0
-
-    for video in videos:
-        total_length += video.length()
-
-    return total_length
-
-def get_input_time(videos, raw_video, t):
-    total_time = 0
-
-    for video in videos:
-        end_time = video.end_time_or_length()
-
-        if (raw_video == video.raw_video and
-            t >= video.start_time and
-            t < end_time):
-            return total_time + t - video.start_time
-
-        total_time += end_time - video.start_time
-
-    raise Exception("Couldn’t find input time in {} at {}".
-                    format(raw_video.filename, t))
+# The same sound file is often used several times in a script so the
+# probe is only started once per filename. It runs in the background
+# so that the sounds can be probed at the same time as everything else.
+@functools.lru_cache(maxsize=None)
+def start_sound_probe(filename):
+    return probe_executor.submit(cached_probe,
+                                 "sound",
+                                 probe_sound_length,
+                                 filename)
 
-def get_output_time(videos, video_speeds, raw_video, time):
-    input_time = get_input_time(videos, raw_video, time)
-    total_input_time = 0
-    total_output_time = 0
-
-    for vs in video_speeds:
-        if input_time < total_input_time + vs.length:
-            return (total_output_time +
-                    (input_time - total_input_time) *
-                    vs.speed)
-
-        total_input_time += vs.length
-        total_output_time += vs.length * vs.speed
-
-    raise Exception("Couldn’t find output time in {} at {}".
-                    format(raw_video.filename, time))
-
-def get_video_speeds(videos, speed_overrides):
-    total_input_length = get_videos_length(videos)
-
-    times = [[get_input_time(videos, st.raw_video, st.start_time),
-              st.length,
-              st.speed]
-             for st in speed_overrides]
+def get_sound_length(filename):
+    return start_sound_probe(filename).result()
+
+class TimeMap:
+    # Converts times in the source videos to times in the concatenated
+    # input and in the final sped-up output. The lookup tables are
+    # built once so that each conversion doesn’t have to walk through
+    # all of the videos and speeds.
+    def __init__(self, videos, video_speeds):
+        # For each raw video, a list of (start_time, end_time,
+        # input_offset) for each time it is used in the script
+        self.video_ranges = {}
+        input_offset = 0
+
+        for video in videos:
+            end_time = video.end_time_or_length()
+            ranges = self.video_ranges.setdefault(video.raw_video, [])
+            ranges.append((video.start_time, end_time, input_offset))
+            input_offset += end_time - video.start_time
+
+        self.total_input_time = input_offset
+
+        # The input and output time at the start of each speed
+        # section and the input time at the end of it
+        self.speeds = [speed for length, speed in video_speeds]
+        input_times = list(itertools.accumulate(
+            (length for length, speed in video_speeds),
+            initial=0))
+        output_times = list(itertools.accumulate(
+            (length * speed for length, speed in video_speeds),
+            initial=0))
+        self.speed_input_starts = input_times[:-1]
+        self.speed_input_ends = input_times[1:]
+        self.speed_output_starts = output_times[:-1]
+
+        self.total_output_time = output_times[-1]
+
+    def is_normal_speed(self):
+        return len(self.speeds) == 1 and self.speeds[0] == 1
+
+    def get_input_time(self, raw_video, t):
+        ranges = self.video_ranges.get(raw_video, [])
+
+        for start_time, end_time, input_offset in ranges:
+            if t >= start_time and t < end_time:
+                return input_offset + t - start_time
+
+        raise Exception("Couldn’t find input time in {} at {}".
+                        format(raw_video.filename, t))
+
+    def get_output_time(self, raw_video, time):
+        input_time = self.get_input_time(raw_video, time)
+
+        i = bisect.bisect_right(self.speed_input_ends, input_time)
+
+        if i >= len(self.speeds):
+            raise Exception("Couldn’t find output time in {} at {}".
+                            format(raw_video.filename, time))
+
+        return (self.speed_output_starts[i] +
+                (input_time - self.speed_input_starts[i]) *
+                self.speeds[i])
+
+def get_video_speeds(videos, speed_overrides, default_speed):
+    time_map = TimeMap(videos, [])
+    total_input_length = time_map.total_input_time
+
+    times = [(time_map.get_input_time(raw_video, start_time), length, speed)
+             for raw_video, start_time, length, speed in speed_overrides]
     times.sort()
 
-    last_time = 0
     video_speeds = []
+    last_time = 0
+
+    for start_time, length, speed in times:
+        end_time = start_time + length
 
-    for t in times:
-        if last_time > 0 and t[0] <= last_time:
-            last_speed = video_speeds[-1]
+        if last_time > 0 and start_time <= last_time:
+            # Overrides that overlap the previous one only affect the
+            # part that extends past it. If the speed is the same then
+            # the previous run is extended instead so that the setpts
+            # expression doesn’t get needlessly long.
+            if end_time > last_time:
+                last_speed = video_speeds[-1]
 
-            if t[0] + t[1] > last_time:
-                if t[2] == video_speeds[-1].speed:
+                if speed == last_speed.speed:
                     video_speeds[-1] = VideoSpeed(last_speed.length +
-                                                  t[0] +
-                                                  t[1] -
+                                                  start_time +
+                                                  length -
                                                   last_time,
-                                                  last_speed.speed)
+                                                  speed)
                 else:
-                    video_speeds.append(VideoSpeed(t[0] + t[1] - last_time,
-                                                   t[2]))
-                last_time = t[0] + t[1]
+                    video_speeds.append(VideoSpeed(end_time - last_time,
+                                                   speed))
+
+                last_time = end_time
         else:
-            if t[0] > last_time:
-                video_speeds.append(VideoSpeed(t[0] - last_time,
-                                               script.default_speed))
+            # Runs at the default speed are kept separate from the
+            # overrides even if the speed is the same because a single
+            # run at normal speed means that the original sound is
+            # kept
+            if start_time > last_time:
+                video_speeds.append(VideoSpeed(start_time - last_time,
+                                               default_speed))
 
-            video_speeds.append(VideoSpeed(t[1], t[2]))
-            last_time = t[0] + t[1]
+            video_speeds.append(VideoSpeed(length, speed))
+            last_time = end_time
 
     if last_time < total_input_length:
         video_speeds.append(VideoSpeed(total_input_length - last_time,
-                                       script.default_speed))
+                                       default_speed))
 
     return video_speeds
 
-def get_sound_clips(videos, video_speeds):
+def get_sound_clips(videos, time_map):
     sound_clips = []
     sound_pos = 0
 
     for video in videos:
-        for sound in video.sounds:
-            sound_clip_pos = get_output_time(videos,
-                                             video_speeds,
-                                             video.raw_video,
-                                             sound.start_time)
+        for start_time, filename in video.sounds:
+            sound_clip_pos = time_map.get_output_time(video.raw_video,
+                                                      start_time)
 
             if sound_clip_pos < sound_pos:
                 raise Exception(("Sound {} overlaps previous sound by {} "
                                  "seconds").
-                                format(sound.filename,
+                                format(filename,
                                        sound_pos - sound_clip_pos))
 
-            if sound_clip_pos > sound_pos:
-                sound_clips.append(SoundClip(None, sound_clip_pos - sound_pos))
-                
-            sound_clips.append(SoundClip(sound.filename, sound.length))
-            sound_pos = sound_clip_pos + sound.length
+            sound_clips.append(SoundClip(sound_clip_pos, filename))
+            sound_pos = sound_clip_pos + get_sound_length(filename)
 
     return sound_clips
 
@@ -598,32 +1037,41 @@ def get_ffmpeg_input_args(script, video):
 
     return args
 
-def get_video_speed_filter(video_speeds):
-    input_time = 0
-    output_time = 0
-    parts = []
-
-    parts.append("setpts='")
-
-    for i, vs in enumerate(video_speeds):
-        if i < len(video_speeds) - 1:
-            parts.append("if(lt(T-STARTT,{}),".format(input_time + vs.length))
-
-        parts.append("STARTPTS+{}/TB+(PTS-STARTPTS-{}/TB)".format(output_time,
-                                                                  input_time))
-        if vs.speed != 1.0:
-            parts.append("*{}".format(vs.speed))
-
-        if i < len(video_speeds) - 1:
-            parts.append(",")
-
-        input_time += vs.length
-        output_time += vs.length * vs.speed
-
-    parts.append(")" * (len(video_speeds) - 1))
+def get_video_speed_filter(time_map):
+    input_starts = time_map.speed_input_starts
+    output_starts = time_map.speed_output_starts
+    input_ends = time_map.speed_input_ends
+    speeds = time_map.speeds
+
+    last = len(speeds) - 1
+
+    # There are usually only a couple of different speeds so the
+    # multiplier for each one only needs to be formatted once
+    multipliers = dict((speed, "*{}".format(speed))
+                       for speed in set(speeds)
+                       if speed != 1.0)
+    multipliers[1.0] = ""
+
+    def section_pts(i):
+        return "STARTPTS+{}/TB+(PTS-STARTPTS-{}/TB){}".format(
+            output_starts[i],
+            input_starts[i],
+            multipliers[speeds[i]])
+
+    parts = ["setpts='"]
+
+    # Every section apart from the last one is chosen with an if
+    # expression that checks whether it has reached the end of the
+    # section yet
+    for i in range(last):
+        parts.append("if(lt(T-STARTT,{}),{},".format(input_ends[i],
+                                                     section_pts(i)))
+
+    parts.append(section_pts(last))
+    parts.append(")" * last)
     parts.append("',")
     parts.append("fps=fps={},".format(FPS))
-    parts.append("trim=duration={}".format(output_time))
+    parts.append("trim=duration={}".format(time_map.total_output_time))
 
     return "".join(parts)
 
@@ -631,12 +1079,18 @@ def get_ffmpeg_filter(script,
                       sound_mode,
                       overlay_input,
                       silent_input,
-                      video_speeds):
+                      time_map):
     parts = []
+    # The inputs for the concat filter are collected in the same pass
+    # as the per-video filters and added after them
+    concat_inputs = []
+    with_audio = sound_mode == "original"
 
-    input_names = ["[{}:v]".format(i) for i in range(len(script.videos))]
+    # All of the videos that need scaling are scaled to the same size
+    scale_filter = "scale={}:{}".format(script.width, script.height)
 
     for i, video in enumerate(script.videos):
+        input_name = "[{}:v]".format(i)
         video_parts = []
 
         if len(video.filter):
@@ -645,51 +1099,51 @@ def get_ffmpeg_filter(script,
         if (video.raw_video.width is not None and
             (video.raw_video.width != script.width or
              video.raw_video.height != script.height)):
-            video_parts.append("scale={}:{}".format(script.width,
-                                                    script.height))
+            video_parts.append(scale_filter)
 
         if len(video_parts) > 0:
             parts.append("[{}]{}[sv{}];".format(i, ",".join(video_parts), i))
-            input_names[i] = "[sv{}]".format(i)
+            input_name = "[sv{}]".format(i)
 
         if len(video.script) > 0:
             if overlay_input is None:
                 parts.append("{}flootay=filename=overlay-{}.flt[ov{}];".format(
-                    input_names[i],
+                    input_name,
                     i,
                     i))
             else:
                 parts.append("{}[{}]{}[ov{}];".format(
-                    input_names[i],
+                    input_name,
                     overlay_input,
                     OVERLAY_FILTER,
                     i))
                 overlay_input += 1
 
-            input_names[i] = "[ov{}]".format(i)
+            input_name = "[ov{}]".format(i)
 
-    if sound_mode == "original":
-        for i, input_name in enumerate(input_names):
-            if script.videos[i].raw_video.is_image:
+        if with_audio:
+            if video.raw_video.is_image:
                 audio_input = silent_input
                 silent_input += 1
             else:
                 audio_input = i
-            parts.append("{}[{}:a]".format(input_name, audio_input))
-    else:
-        parts.append("".join(input_names))
+            concat_inputs.append("{}[{}:a]".format(input_name, audio_input))
+        else:
+            concat_inputs.append(input_name)
+
+    parts.extend(concat_inputs)
 
     parts.append("concat=n={}:v=1:a={}".format(len(script.videos),
-                                               int(sound_mode == "original")))
+                                               int(with_audio)))
 
-    if is_normal_speed(video_speeds):
+    if time_map.is_normal_speed():
         parts.append("[outv]")
 
-        if sound_mode == "original":
+        if with_audio:
             parts.append("[outa]")
     else:
         parts.append(",")
-        parts.append(get_video_speed_filter(video_speeds))
+        parts.append(get_video_speed_filter(time_map))
         parts.append("[outv]")
 
     return "".join(parts)
@@ -697,17 +1151,17 @@ def get_ffmpeg_filter(script,
 def check_ffmpeg_has_flootay():
     filters = subprocess.check_output(["ffmpeg", "-hide_banner", "-filters"],
                                       encoding="utf-8")
-    return re.search(r'^\s*...\s+flootay\s+', filters, re.MULTILINE) is not None
+    return FLOOTAY_FILTER_RE.search(filters) is not None
 
-def get_ffmpeg_command(script, video_filename, video_speeds):
-    input_args = (["ffmpeg"] +
-                  sum((get_ffmpeg_input_args(script, video)
-                       for video in script.videos),
-                      []))
+def get_ffmpeg_command(script, video_filename, time_map):
+    input_args = ["ffmpeg"]
+    input_args.extend(itertools.chain.from_iterable(
+        get_ffmpeg_input_args(script, video)
+        for video in script.videos))
 
     next_input = len(script.videos)
 
-    sound_mode = get_sound_mode(script, video_speeds)
+    sound_mode = get_sound_mode(script, time_map)
 
     has_flootay = check_ffmpeg_has_flootay()
 
@@ -764,16 +1218,18 @@ def get_ffmpeg_command(script, video_filename, video_speeds):
         overlay_filter = "[outv][{}]{}[overoutv]".format(flootay_input,
                                                          OVERLAY_FILTER)
 
-    filter = (get_ffmpeg_filter(script,
-                                sound_mode,
-                                first_overlay_input,
-                                sound_input,
-                                video_speeds) +
-              ";" +
-              overlay_filter)
+    filter = ";".join([get_ffmpeg_filter(script,
+                                         sound_mode,
+                                         first_overlay_input,
+                                         sound_input,
+                                         time_map),
+                       overlay_filter])
 
-    args = input_args + ["-filter_complex", filter,
-                         "-map", "[overoutv]"]
+    # The input args aren’t needed separately so the rest of the
+    # arguments can be added directly to the list instead of copying it
+    args = input_args
+    args.extend(["-filter_complex", filter,
+                 "-map", "[overoutv]"])
 
     if sound_mode == "generate":
         args.extend(["-map", "{}:a".format(sound_input)])
@@ -799,75 +1255,65 @@ def get_ffmpeg_command(script, video_filename, video_speeds):
 
     return args
 
-def write_sound_script(f, total_video_time, sound_clips):
-    dirname = os.path.dirname(sys.argv[0])
+def write_sound_script(f, script, total_video_time, sound_clips):
+    dirname = SCRIPT_DIR
     if len(dirname) == 0:
         dirname = "."
     exe = os.path.join(dirname, "build", "generate-sound")
 
-    sound_args = " ".join(shlex.quote(a) for a in script.sound_args)
+    sound_args = shlex.join(script.sound_args)
 
-    print(("#!/bin/bash\n"
-           "\n"
-           "exec {} -E {} {}").format(exe, total_video_time, sound_args),
-          end='',
-          file=f)
+    parts = [("#!/bin/bash\n"
+              "\n"
+              "exec {} -E {} {}").format(exe, total_video_time, sound_args)]
 
-    pos = 0
+    for start_time, filename in sound_clips:
+        parts.append(" -s {} {}".format(start_time, shlex.quote(filename)))
 
-    for clip in sound_clips:
-        if clip.filename:
-            print(" -s {} {}".format(pos, shlex.quote(clip.filename)),
-                  end='',
-                  file=f)
-        pos += clip.length
+    parts.append("\n")
 
-    print("", file=f)
+    f.write("".join(parts))
 
-def write_score_script(f, script, video_speeds):
+def write_score_script(f, script, time_map):
     if len(script.scores) <= 0:
         return
 
-    print("score {", file=f)
+    parts = ["score {\n"]
 
     if script.text_color is not None:
-        print("        color {}\n".format(script.text_color),
-              file=f)
+        parts.append("        color {}\n\n".format(script.text_color))
 
     value = 0
 
-    for score in script.scores:
-        value += score.diff
-        time = get_output_time(script.videos,
-                               video_speeds,
-                               score.video.raw_video,
-                               score.time)
-        print("        key_frame {} {{ v {} }}".format(time, value),
-              file=f)
-
-    end_time = sum(vs.length * vs.speed for vs in video_speeds)
-
-    print("        key_frame {} {{ v {} }}\n".format(end_time, value) +
-          "}\n",
-          file=f)
-
-def write_svg_script(f, script, video_speeds):
-    for svg in script.svgs:
-        start_time = get_output_time(script.videos,
-                                     video_speeds,
-                                     svg.video.raw_video,
-                                     svg.start_time)
-
-        print(("svg {{\n"
-               "        file \"{}\"\n"
-               "        key_frame {} {{ x1 0 y1 0 x2 {} y2 {} }}\n"
-               "        key_frame {} {{ }}\n"
-               "}}\n").format(svg.filename,
-                              start_time,
-                              script.width,
-                              script.height,
-                              start_time + svg.length),
-              file=f)
+    for video, score_time, diff in script.scores:
+        value += diff
+        time = time_map.get_output_time(video.raw_video, score_time)
+        parts.append("        key_frame {} {{ v {} }}\n".format(time, value))
+
+    end_time = time_map.total_output_time
+
+    parts.append("        key_frame {} {{ v {} }}\n"
+                 "}}\n\n".format(end_time, value))
+
+    f.write("".join(parts))
+
+def write_svg_script(f, script, time_map):
+    parts = []
+
+    for video, filename, svg_start_time, length in script.svgs:
+        start_time = time_map.get_output_time(video.raw_video, svg_start_time)
+
+        parts.append(("svg {{\n"
+                      "        file \"{}\"\n"
+                      "        key_frame {} {{ x1 0 y1 0 x2 {} y2 {} }}\n"
+                      "        key_frame {} {{ }}\n"
+                      "}}\n\n").format(filename,
+                                       start_time,
+                                       script.width,
+                                       script.height,
+                                       start_time + length))
+
+    f.write("".join(parts))
 
 def filename_sort_key(filename):
     # GoPro using an annoying filename system where the chapter
@@ -884,10 +1330,15 @@ def filename_sort_key(filename):
             '.mp4')
 
 def get_video_gpx_offsets(script):
-    raw_footage = dict((os.path.basename(video.raw_video.filename),
-                        video.raw_video.length)
-                       for video in script.videos
-                       if video.use_gpx)
+    basenames = {}
+    raw_footage = {}
+
+    for video in script.videos:
+        if video.use_gpx and video.raw_video not in basenames:
+            bn = os.path.basename(video.raw_video.filename)
+            basenames[video.raw_video] = bn
+            raw_footage[bn] = video.raw_video.length
+
     sorted_filenames = list(sorted(raw_footage.keys(), key=filename_sort_key))
 
     last_offset = None
@@ -914,11 +1365,10 @@ def get_video_gpx_offsets(script):
         if filename not in offsets:
             offsets[filename] = last_offset
 
-    return offsets
+    return dict((raw_video, offsets[bn])
+                for raw_video, bn in basenames.items())
 
-def get_speed_script_for_video(script,
-                               video,
-                               gpx_offset):
+def get_gpx_script_header(script):
     parts = ["gpx {\n"]
 
     def add_part(name, extra=None):
@@ -935,9 +1385,9 @@ def get_speed_script_for_video(script,
                        "                width {}\n"
                        "                height {}\n"
                        "                full_speed {}\n").format(
-                           os.path.join(os.path.dirname(sys.argv[0]),
+                           os.path.join(SCRIPT_DIR,
                                         "dial.svg"),
-                           os.path.join(os.path.dirname(sys.argv[0]),
+                           os.path.join(SCRIPT_DIR,
                                         "needle.svg"),
                            script.height / 5.0,
                            script.height / 5.0,
@@ -962,18 +1412,19 @@ def get_speed_script_for_video(script,
     if script.show_map:
         parts.append("        map {}\n")
 
-    timestamp = gpx_offset[0] + video.start_time
+    return "".join(parts)
 
-    parts.append(("        file \"{}\"\n"
-                  "        key_frame {} {{ timestamp {} }}\n"
-                  "        key_frame {} {{ timestamp {} }}\n"
-                  "}}\n").format(gpx_offset[1],
-                                 video.start_time,
-                                 timestamp,
-                                 video.end_time_or_length(),
-                                 timestamp + video.length()))
+def get_speed_script_for_video(header, video, gpx_offset):
+    timestamp = gpx_offset[0] + video.start_time
 
-    return "".join(parts)
+    return header + ("        file \"{}\"\n"
+                     "        key_frame {} {{ timestamp {} }}\n"
+                     "        key_frame {} {{ timestamp {} }}\n"
+                     "}}\n").format(gpx_offset[1],
+                                    video.start_time,
+                                    timestamp,
+                                    video.end_time_or_length(),
+                                    timestamp + video.length())
 
 def add_speed_scripts(script):
     if len(script.gpx_offsets) == 0:
@@ -981,12 +1432,16 @@ def add_speed_scripts(script):
 
     offsets = get_video_gpx_offsets(script)
 
+    # The parts of the gpx script that don’t depend on the video are
+    # the same every time so they only need to be generated once
+    header = get_gpx_script_header(script)
+
     for video in script.videos:
         if video.use_gpx:
-            bn = os.path.basename(video.raw_video.filename)
-            video.script.append(get_speed_script_for_video(script,
+            offset = offsets[video.raw_video]
+            video.script.append(get_speed_script_for_video(header,
                                                            video,
-                                                           offsets[bn]))
+                                                           offset))
 
 def add_time_scripts(script):
     timestamp = 0
@@ -1012,13 +1467,12 @@ def add_time_scripts(script):
         timestamp += length
 
 def write_video_script(f, video):
-    script_time_re = re.compile(r'\bkey_frame\s+(?P<time>' +
-                                TIME_RE.pattern +
-                                r')')
-
     end_time = video.end_time_or_length()
+    text = "\n".join(video.script)
+    parts = []
+    pos = 0
 
-    def replace_video_time(md):
+    for md in SCRIPT_TIME_RE.finditer(text):
         t = decode_time(md.group('time')) - video.start_time
         if t < 0:
             raise Exception("Time in flootay script is negative "
@@ -1028,10 +1482,23 @@ def write_video_script(f, video):
             raise Exception("Time in flootay script is past end of video "
                             "for {} in {}".format(
                                 md.group('time'), video.raw_video.filename))
-        return md.group(0)[:(md.start('time') - md.start(0))] + str(t)
+        parts.append(text[pos:md.start('time')])
+        parts.append(str(t))
+        pos = md.end('time')
+
+    parts.append(text[pos:])
+    parts.append("\n")
+
+    f.write("".join(parts))
+
+def write_video_overlay(video_num, video, header):
+    filename = "overlay-{}.flt".format(video_num)
+
+    with open(filename, "wt", encoding="utf-8") as f:
+        print(header, file=f)
+        write_video_script(f, video)
 
-    print(script_time_re.sub(replace_video_time, "\n".join(video.script)),
-          file=f)
+    os.chmod(filename, 0o775)
 
 if len(sys.argv) >= 2:
     video_filename = os.path.splitext(sys.argv[1])[0] + ".mp4"
@@ -1041,14 +1508,18 @@ else:
     video_filename = "film.mp4"
     script = parse_script(sys.stdin)
 
-video_speeds = get_video_speeds(script.videos, script.speed_overrides)
-total_video_time = sum(vs.length * vs.speed for vs in video_speeds)
+video_speeds = get_video_speeds(script.videos,
+                                script.speed_overrides,
+                                script.default_speed)
+time_map = TimeMap(script.videos, video_speeds)
+total_video_time = time_map.total_output_time
 
-if script_has_sound(script):
+if script.has_sound:
     with open("sound.sh", "wt", encoding="utf-8") as f:
         write_sound_script(f,
+                           script,
                            total_video_time,
-                           get_sound_clips(script.videos, video_speeds))
+                           get_sound_clips(script.videos, time_map))
 
     os.chmod("sound.sh", 0o775)
 
@@ -1057,7 +1528,7 @@ add_speed_scripts(script)
 if script.show_time:
     add_time_scripts(script)
 
-flootay_proc = os.path.join(os.path.dirname(sys.argv[0]),
+flootay_proc = os.path.join(SCRIPT_DIR,
                             "build",
                             "flootay")
 flootay_header = (("#!{}\n"
@@ -1070,25 +1541,18 @@ flootay_header = (("#!{}\n"
 
 with open("overlay.flt", "wt", encoding="utf-8") as f:
     print(flootay_header, file=f)
-    write_score_script(f, script, video_speeds)
-    write_svg_script(f, script, video_speeds)
+    write_score_script(f, script, time_map)
+    write_svg_script(f, script, time_map)
 
 os.chmod("overlay.flt", 0o775)
 
 for video_num, video in enumerate(script.videos):
-    if len(video.script) == 0:
-        continue
+    if len(video.script) > 0:
+        write_video_overlay(video_num, video, flootay_header)
 
-    filename = "overlay-{}.flt".format(video_num)
-    with open(filename, "wt", encoding="utf-8") as f:
-        print(flootay_header, file=f)
-        write_video_script(f, video)
-    os.chmod(filename, 0o775)
-
-print(os.path.join(os.path.dirname(sys.argv[0]),
+print(os.path.join(SCRIPT_DIR,
                    "build",
                    "run-ffmpeg"),
-      " ".join(shlex.quote(arg)
-               for arg in get_ffmpeg_command(script,
-                                             video_filename,
-                                             video_speeds)))
+      shlex.join(get_ffmpeg_command(script, video_filename, time_map)))
+
+save_probe_cache()
@@ -19,6 +19,8 @@
 import re
 import sys
 
+TIME_RE = re.compile(r'((?:[0-9]+:)+)([0-9]+(?:\.[0-9]+)?)')
+
 def remove_leading_zeroes(num):
     start = 0
     while start < len(num) - 1 and num[start] == "0":
@@ -41,7 +43,7 @@ def convert(e):
 
         return "".join(parts)
 
-    return re.sub(r'((?:[0-9]+:)+)([0-9]+(?:\.[0-9]+)?)', replace, e)
+    return TIME_RE.sub(replace, e)
 
 def display(num):
     parts = []
@@ -50,26 +52,23 @@ def display(num):
         parts.append('-')
         num = -num
 
-    comp = 60
-    factor = 0
-
-    while num >= comp:
-        comp *= 60
-        factor += 1
+    int_part = int(num)
+    frac = num - int_part
 
-    for i in range(factor):
-        comp //= 60
-        parts.append("{:02d}".format(int(num / comp)))
-        parts.append(':')
-        num %= comp
+    # Split the whole seconds into hours, minutes and seconds, with
+    # the smallest unit first
+    units = []
 
-    int_part = int(num)
-    parts.append("{:02d}".format(int_part))
+    while True:
+        int_part, unit = divmod(int_part, 60)
+        units.append(unit)
+        if int_part == 0:
+            break
 
-    num -= int_part
+    parts.append(":".join("{:02d}".format(unit) for unit in reversed(units)))
 
-    if num != 0:
-        parts.append(str(num)[1:])
+    if frac != 0:
+        parts.append(str(frac)[1:])
 
     return "".join(parts)
 